@@ -10,9 +10,52 @@ Date : 05/01/2022
 Version : 0.1
 
 '''
+import asyncio
+import hashlib
+import json
 import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
 from urllib.parse import urljoin
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # fcntl is POSIX only, without it the token cache is used unlocked
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    # orjson encodes and decodes much faster, fall back to json without it
+    from orjson import loads as _loads, dumps as _dumps
+except ImportError:
+    from json import loads as _loads
+
+    def _dumps(obj):
+        ''' Serialize obj to JSON bytes, the same as orjson.dumps '''
+        return json.dumps(obj, separators=(',', ':')).encode()
+
+try:
+    # ijson is optional, only needed to stream service items
+    import ijson
+except ImportError:
+    ijson = None
+
+# httpx is optional, only needed for HTTP/2 sessions. It is imported by the
+# first _build_http2_session so it does not slow down every module start.
+httpx = None
+
+# Errors raised for 4xx and 5xx replies by the HTTP clients in use
+_STATUS_ERRORS = (requests.HTTPError,)
+# Any error raised by the helpers when a request to NetOrca fails. The httpx
+# errors are added once an HTTP/2 session is built, so read it after that.
+REQUEST_ERRORS = (requests.RequestException,)
 
 try:
     # Try to import the module from the local folder
@@ -22,119 +65,928 @@ except  ModuleNotFoundError:
     # so the ansible namespace needs to be used.
     import ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_constants  as const
 
+# Nothing is logged unless the caller configures the netorca logger
+logger = logging.getLogger('netorca')
+logger.addHandler(logging.NullHandler())
+# Environment variable naming a file to write a debug log of the modules to
+_DEBUG_LOG_ENV = 'NETORCA_DEBUG_LOG'
+
+def ensure_logger():
+    '''
+    Write the netorca logs to the file named by NETORCA_DEBUG_LOG, if it is
+    set. The file is only opened when the first record is written, and
+    nothing is configured at all without the variable. Safe to call again.
+    '''
+    path = os.environ.get(_DEBUG_LOG_ENV)
+    if not path or any(isinstance(handler, logging.FileHandler)
+                       for handler in logger.handlers):
+        return
+    handler = logging.FileHandler(path, delay=True)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
 _PATH_LOGIN = "/api-token-auth/"
 _PATH_CHANGE_INSTANCES = "/orcabase/change_instances/"
 _PATH_SERVICE_ITEMS = "/orcabase/service_items/"
+_PATH_CHANGE_INSTANCES_BULK = "/orcabase/change_instances/bulk/"
+
+# The change instances are filtered on service_name by NetOrca. Older
+# servers ignore that filter, so the results are checked again locally
+# until they have all been upgraded. Callers that only talk to upgraded
+# servers pass filter_locally=False, which also skips service_item.
+FILTER_SERVICE_LOCALLY = True
+
+_POOL_CONNECTIONS = 4
+_POOL_MAXSIZE = 32
+# Seconds to wait for NetOrca to connect or reply before a request fails
+TIMEOUT = 10.0
+# Number of change instances updated in parallel by default
+MAX_WORKERS = 8
+# Most change instances sent in one bulk update
+BULK_BATCH_SIZE = 50
+# Results requested per page from the paginated endpoints
+_PAGE_SIZE = 500
+# Number of change instances updated concurrently by the async helpers
+_ASYNC_CONCURRENCY = 32
+
+# Tokens are cached between module runs so each task does not log in again
+_TOKEN_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'netorca', 'token.json')
+_TOKEN_CACHE_TTL = 3000
+
+# Pages read in the last few seconds are reused, older ones are revalidated
+# with their ETag. Maps (url, auth, params) to (expiry, etag, body).
+_RESPONSE_CACHE = {}
+_RESPONSE_CACHE_TTL = 30
+_RESPONSE_CACHE_SIZE = 128
+
+# Base urls of NetOrca servers without the bulk update endpoint
+_BULK_UNSUPPORTED = set()
 
-def login(base_url,username,password):
+@lru_cache(maxsize=32)
+def _endpoint(base_url, path):
+    ''' Join the base url and an API path, memoized as urljoin parses both '''
+    return urljoin(base_url, path)
+
+def _change_instance_url(base_url, uuid):
+    ''' The url of a single change instance '''
+    return f'{_endpoint(base_url, _PATH_CHANGE_INSTANCES)}{uuid}/'
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    ''' HTTPAdapter that gives every request a timeout unless it has one '''
+
+    def __init__(self, *args, timeout=TIMEOUT, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs): # pylint: disable=arguments-differ
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+def build_session(token=None, http2=False, max_workers=MAX_WORKERS, timeout=TIMEOUT):
+    '''
+    Build a requests Session that keeps HTTP keep-alive connections to the
+    NetOrca host, so consecutive calls skip the TCP and TLS handshake.
+    If a token is given the session is authorized with it.
+    The pool keeps at least max_workers connections, so that many parallel
+    updates never wait on each other for a connection.
+    Every request made through the session fails after timeout seconds
+    without a connection or reply, instead of hanging the task.
+    If http2 is True an httpx Client is built instead, which multiplexes
+    parallel requests over one HTTP/2 connection. It needs httpx[http2].
+    '''
+    if http2:
+        return _build_http2_session(token, max_workers, timeout)
+    session = requests.Session()
+    adapter = _TimeoutHTTPAdapter(
+        timeout=timeout,
+        pool_connections=_POOL_CONNECTIONS,
+        pool_maxsize=max(_POOL_MAXSIZE, max_workers),
+        max_retries=Retry(
+            total=5,
+            # A reply that timed out once is likely to time out again
+            read=2,
+            backoff_factor=0.3,
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+            # All the NetOrca calls made here are safe to repeat
+            allowed_methods={'GET', 'PUT', 'POST', 'PATCH'},
+            # Return the last reply so raise_for_status reports it
+            raise_on_status=False
+        )
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if token:
+        authorize_session(session, token)
+    return session
+
+def _import_httpx():
+    ''' Import httpx on first use and add its errors to the error tuples '''
+    global httpx, _STATUS_ERRORS, REQUEST_ERRORS # pylint: disable=global-statement
+    if httpx is None:
+        try:
+            import httpx as _httpx # pylint: disable=import-outside-toplevel
+        except ImportError as error:
+            raise ImportError("httpx[http2] is required for HTTP/2 sessions") from error
+        httpx = _httpx
+        _STATUS_ERRORS = (requests.HTTPError, httpx.HTTPStatusError)
+        REQUEST_ERRORS = (requests.RequestException, httpx.HTTPError)
+
+def _build_http2_session(token=None, max_workers=MAX_WORKERS, timeout=TIMEOUT):
+    ''' Build an httpx Client with HTTP/2, used like a requests Session '''
+    _import_httpx()
+    session = httpx.Client(
+        http2=True,
+        timeout=timeout,
+        # The client ignores its own limits when given a transport, so the
+        # pool is sized here. httpx only retries failed connections, not
+        # error replies.
+        transport=httpx.HTTPTransport(
+            http2=True,
+            retries=3,
+            limits=httpx.Limits(
+                max_keepalive_connections=_POOL_CONNECTIONS * 2,
+                max_connections=max(_POOL_MAXSIZE, max_workers)
+            )
+        )
+    )
+    if token:
+        authorize_session(session, token)
+    return session
+
+def authorize_session(session, token):
+    '''
+    Set the Authorization header for the token on the session, so the
+    helpers can be called with token=None and do not build it per call.
+    '''
+    session.headers['Authorization'] = f'Token {token}'
+    return session
+
+def _auth_headers(token):
+    ''' Per request headers for the token, None if the session carries it '''
+    if token is None:
+        return None
+    return {'Authorization': f'Token {token}'}
+
+def _is_unauthorized(error):
+    ''' True if error is a reply from NetOrca rejecting the token '''
+    # Transport errors carry no response
+    return getattr(getattr(error, 'response', None), 'status_code', None) == 401
+
+def _json_body(session, token, data):
+    '''
+    Keyword arguments sending data as a JSON body serialized with _dumps,
+    for either a requests Session or an httpx Client.
+    '''
+    headers = dict(_auth_headers(token) or {}, **{'Content-Type': 'application/json'})
+    # httpx takes raw bytes as content, requests as data
+    key = 'content' if httpx is not None and isinstance(session, httpx.Client) else 'data'
+    return {'headers': headers, key: _dumps(data)}
+
+# Shared session used when the caller does not supply one
+_SESSION = build_session()
+
+def _token_cache_key(base_url, username):
+    ''' The token cache is keyed on a hash of the url and username '''
+    return hashlib.sha256(f'{base_url}|{username}'.encode()).hexdigest()
+
+@contextmanager
+def _token_cache_lock(exclusive=False):
+    '''
+    Hold a lock on the token cache while it is used, so that parallel module
+    runs, e.g. one per host, never read a half written cache or drop each
+    other's tokens. Shared for reading, exclusive for updating the cache.
+    '''
+    if fcntl is None:
+        yield
+        return
+    try:
+        os.makedirs(os.path.dirname(_TOKEN_CACHE_PATH), mode=0o700, exist_ok=True)
+        lock_fd = os.open(_TOKEN_CACHE_PATH + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError as error:
+        # The cache is only an optimisation, carry on without the lock
+        logger.debug("Could not lock token cache: %s", error)
+        yield
+        return
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+    finally:
+        # Closing the file releases the lock
+        os.close(lock_fd)
+
+def _read_token_cache():
+    ''' Return the token cache as a dictionary, empty if it is unreadable '''
+    try:
+        with open(_TOKEN_CACHE_PATH, encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+def _write_token_cache(cache):
+    ''' Write the token cache, readable only by the current user '''
+    try:
+        os.makedirs(os.path.dirname(_TOKEN_CACHE_PATH), mode=0o700, exist_ok=True)
+        cache_fd = os.open(_TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(cache_fd, 'w', encoding='utf-8') as cache_file:
+            json.dump(cache, cache_file)
+    except OSError as error:
+        # The cache is only an optimisation, carry on without it
+        logger.debug("Could not write token cache: %s", error)
+
+def _cached_token(base_url, username):
+    ''' Return the cached token for the user, or None if missing or expired '''
+    with _token_cache_lock():
+        entry = _read_token_cache().get(_token_cache_key(base_url, username))
+    if entry and entry['exp'] > time.time():
+        return entry['token']
+    return None
+
+def _cache_token(base_url, username, token):
+    ''' Store the token for the user, dropping any expired entries '''
+    now = time.time()
+    with _token_cache_lock(exclusive=True):
+        cache = {
+            key: entry for key, entry in _read_token_cache().items()
+            if entry['exp'] > now
+        }
+        cache[_token_cache_key(base_url, username)] = {
+            'token': token,
+            'exp': now + _TOKEN_CACHE_TTL
+        }
+        _write_token_cache(cache)
+
+def forget_token(base_url, username):
+    ''' Remove the cached token for the user, e.g. after it was rejected '''
+    with _token_cache_lock(exclusive=True):
+        cache = _read_token_cache()
+        if cache.pop(_token_cache_key(base_url, username), None):
+            _write_token_cache(cache)
+
+def login(base_url, username, password, session=None, use_cache=True,
+          save_token=True):
     '''
     Login in to Netroca with given credentials and return a token as a string
+    A token cached by a previous login is returned without calling NetOrca,
+    unless use_cache is False. The new token is cached unless save_token is
+    False.
     '''
-    url = urljoin(base_url, _PATH_LOGIN)
+    token, _ = _login(base_url, username, password, session=session,
+                      use_cache=use_cache, save_token=save_token)
+    return token
+
+def _login(base_url, username, password, session=None, use_cache=True,
+           save_token=True):
+    ''' login, returning the token and whether it came from the cache '''
+    if use_cache:
+        token = _cached_token(base_url, username)
+        if token:
+            logger.debug('Using cached token')
+            return token, True
+    session = session or _SESSION
+    url = _endpoint(base_url, _PATH_LOGIN)
     data = {
         "username": username,
         "password": password
          }
-    logging.debug(data)
-    response = requests.post(url, json=data)
-    logging.debug(response.content)
-    return response.json()['token']
+    # The credentials and the reply with the token are never logged
+    logger.debug('Logging in to %s as %s', base_url, username)
+    # Never send a previous, possibly rejected, token when logging in
+    session.headers.pop('Authorization', None)
+    response = session.post(url, json=data)
+    response.raise_for_status()
+    token = _loads(response.content)['token']
+    if save_token:
+        _cache_token(base_url, username, token)
+    return token, False
+
+def call_authenticated(func, base_url, token=None, username=None, password=None,
+                       session=None, token_cache=True, **kwargs):
+    '''
+    Call func(base_url, None, session=session, **kwargs) with the session
+    authorized for the token.
+    If no token is given, login with the username and password first. When
+    NetOrca rejects a cached token it is forgotten, and the call is retried
+    once after a fresh login. With token_cache False the on-disk token cache
+    is neither read nor written.
+    The session should be one built for this caller, as it keeps the token.
+    '''
+    if token:
+        logger.debug('API key provided, skipping logging in')
+        authorize_session(session, token)
+        return func(base_url, None, session=session, **kwargs)
+    logger.debug('No API key provided, logging in')
+    token, from_cache = _login(base_url, username, password, session=session,
+                               use_cache=token_cache, save_token=token_cache)
+    authorize_session(session, token)
+    try:
+        return func(base_url, None, session=session, **kwargs)
+    except _STATUS_ERRORS as error:
+        # Only a token from the cache can be stale, a fresh one is not retried
+        if not from_cache or error.response is None or \
+                error.response.status_code != 401:
+            raise
+    logger.debug('Token rejected, logging in again')
+    forget_token(base_url, username)
+    token = login(base_url, username, password, session=session, use_cache=False)
+    authorize_session(session, token)
+    return func(base_url, None, session=session, **kwargs)
+
+def _paginate(session, url, params, headers):
+    '''
+    Yield the results of a paginated NetOrca endpoint one page at a time,
+    following the next links until the last page.
+    '''
+    params = dict(params, page_size=_PAGE_SIZE)
+    while url:
+        response = _get_page(session, url, params, headers)
+        # An empty page may omit results altogether
+        yield from response.get('results') or ()
+        # The next link already carries the query string
+        url = response.get('next')
+        params = None
+
+def _get_page(session, url, params, headers):
+    '''
+    GET a single page and return the decoded body.
+    A page fetched less than _RESPONSE_CACHE_TTL seconds ago is returned
+    from the cache. Otherwise a cached ETag is sent as If-None-Match, and
+    the cached body is reused if NetOrca answers 304 Not Modified.
+    '''
+    auth = (headers or session.headers).get('Authorization')
+    key = (url, auth, tuple(sorted((params or {}).items())))
+    cached = _RESPONSE_CACHE.get(key)
+    if cached and cached[0] > time.time():
+        return cached[2]
+    if cached and cached[1]:
+        headers = dict(headers or {}, **{'If-None-Match': cached[1]})
+    response = session.get(url, params=params, headers=headers)
+    if cached and response.status_code == 304:
+        # Checked first as httpx raises for a 304 in raise_for_status
+        body = cached[2]
+    else:
+        response.raise_for_status()
+        body = _loads(response.content)
+    if response.status_code in (200, 304):
+        if key not in _RESPONSE_CACHE and len(_RESPONSE_CACHE) >= _RESPONSE_CACHE_SIZE:
+            # Evict the oldest entry
+            _RESPONSE_CACHE.pop(next(iter(_RESPONSE_CACHE)), None)
+        etag = response.headers.get('ETag') or (cached and cached[1])
+        _RESPONSE_CACHE[key] = (time.time() + _RESPONSE_CACHE_TTL, etag, body)
+    return body
+
+def clear_response_cache():
+    ''' Drop all cached pages, called after anything is changed on NetOrca '''
+    _RESPONSE_CACHE.clear()
+
+_service_item = itemgetter('service_item')
+
+def _iter_filter_service(changes, service):
+    ''' Lazily filter change instances based on the service '''
+    return (
+        change for change in changes
+        if _service_item(change)['service']['name'] == service
+    )
 
 def filter_change_instances(changes, service=''):
     ''' Filter a list of change instances based on the service '''
-    result = []
-    for change in changes:
-        if change['service_item']['service']['name'] == service:
-            result.append(change)
-    return result
+    return list(_iter_filter_service(changes, service))
 
 # Get Change Instance & Filter
-def get_change_instances(base_url, token, state='', service_name='' ):
+def get_change_instances(base_url, token, state='', service_name='', session=None,
+                         stream=False, fields=None, filter_locally=FILTER_SERVICE_LOCALLY):
     '''
     Get all the change instances for the given team token.
     If state is not empty, filter for only the given state.
-    If service is not empty, filter replies for only that service.
+    If service is not empty, filter replies for only that service. With
+    filter_locally the replies are checked against it again here, which
+    needs their service_item.
+    If fields is given, only those fields of each change instance are
+    requested. Servers without sparse fieldsets return every field.
+    If stream is True an iterator is returned that fetches the pages
+    as it is consumed, instead of a list.
     '''
-    url = urljoin(base_url, _PATH_CHANGE_INSTANCES)
-    if state :
-        url = urljoin(url, f'?state={state}')
+    session = session or _SESSION
+    url = _endpoint(base_url, _PATH_CHANGE_INSTANCES)
+    params = _change_instance_params(state, service_name, fields)
 
-    response = requests.get(url, headers={'Authorization': f'Token {token}'}).json()
-    # FIXME handle 401, 500 or other errors
     # TODO Add filter to get only CREATE or MODIFY flags
-    if response['count'] == 0:
-        return []
+    changes = _paginate(
+        session,
+        url,
+        params,
+        headers=_auth_headers(token)
+    )
+    if service_name and filter_locally:
+        changes = _iter_filter_service(changes, service_name)
+    return changes if stream else list(changes)
+
+def _change_instance_params(state='', service_name='', fields=None):
+    ''' Build the query string filters for the change instances endpoint '''
+    params = {}
+    if state:
+        params['state'] = state
     if service_name:
-        return filter_change_instances(response['results'], service=service_name)
-    return response['results']
+        params['service_name'] = service_name
+    if fields:
+        params['fields'] = ','.join(fields)
+    return params
+
+def _completion_fields(filter_locally=FILTER_SERVICE_LOCALLY):
+    ''' The change instance fields needed to complete the changes '''
+    if filter_locally:
+        # Needed to check the service of each change
+        return ('uuid', 'service_item')
+    return ('uuid',)
+
+def get_change_instance(base_url, token, uuid, session=None):
+    '''
+    Get the change instance specified by the UUID.
+    The reply is kept in the response cache like the paginated GETs, so
+    asking for the same change instance again before an update is free.
+    '''
+    session = session or _SESSION
+    url = _change_instance_url(base_url, uuid)
+    return _get_page(session, url, None, _auth_headers(token))
+
+def _has_values(change, data):
+    ''' True if the change instance already has every value in data '''
+    return all(change.get(key) == value for key, value in data.items() if key != 'uuid')
 
 # Get all service items for team
-def get_service_items(base_url, token, service_name):
+def get_service_items(base_url, token, service_name, session=None, stream=False):
     '''
     Get all the service items that match the service_name
+    If stream is True an iterator is returned instead of a list.
     '''
-    url = urljoin(base_url, _PATH_SERVICE_ITEMS)
-    url = urljoin(url, f'?service_name={service_name}')
+    session = session or _SESSION
+    url = _endpoint(base_url, _PATH_SERVICE_ITEMS)
 
-    response = requests.get(url, headers={'Authorization': f'Token {token}'}).json()
     # TODO skip any 'PENDING' items
-    # FIXME handle 401, 500 or other errors
-    if response['count'] == 0:
-        return []
-    return response['results']
+    items = _paginate(
+        session,
+        url,
+        {'service_name': service_name},
+        headers=_auth_headers(token)
+    )
+    return items if stream else list(items)
+
+def iter_service_items(base_url, token, service_name, session=None):
+    '''
+    Yield the service items that match the service_name while each page is
+    still being read, so a large page is never held in memory as a whole.
+    Without ijson, or with an HTTP/2 session, each page is decoded whole.
+    These pages are never cached.
+    '''
+    session = session or _SESSION
+    if ijson is None or not isinstance(session, requests.Session):
+        yield from get_service_items(base_url, token, service_name, session=session, stream=True)
+        return
+    url = _endpoint(base_url, _PATH_SERVICE_ITEMS)
+    params = {'service_name': service_name, 'page_size': _PAGE_SIZE}
+    while url:
+        with session.get(url, params=params, headers=_auth_headers(token),
+                         stream=True) as response:
+            response.raise_for_status()
+            # Let urllib3 undo any gzip encoding before ijson reads it
+            response.raw.decode_content = True
+            url = None
+            events = ijson.parse(response.raw, use_float=True)
+            for prefix, event, value in events:
+                if prefix == 'next' and event in ('string', 'null'):
+                    url = value
+                elif prefix == 'results.item' and event == 'start_map':
+                    yield _build_item(events, event, value)
+        params = None
+
+def _build_item(events, event, value):
+    ''' Build one results item from the ijson events that make it up '''
+    builder = ijson.ObjectBuilder()
+    builder.event(event, value)
+    for prefix, event, value in events:
+        builder.event(event, value)
+        if prefix == 'results.item' and event == 'end_map':
+            break
+    return builder.value
 
 # Update Change Instance
-def update_change_instance(base_url, token, uuid, data):
+def update_change_instance(base_url, token, uuid, data, session=None):
     '''
     Updates the change instance specified by the UUID
     Data should be a dictionary
     '''
-    url = urljoin(base_url, _PATH_CHANGE_INSTANCES)
-    url = urljoin(url, f'{uuid}/', )
-    logging.debug(data)
-    response = requests.put(
-        url,
-        headers={'Authorization': f'Token {token}'},
-        json=data
-        ).json()
-    logging.debug(response)
+    session = session or _SESSION
+    url = _change_instance_url(base_url, uuid)
+    logger.debug('Updating CI %s: %s', uuid, data)
+    response = session.put(url, **_json_body(session, token, data))
+    clear_response_cache()
+    response.raise_for_status()
+    response = _loads(response.content)
+    logger.debug('Updated CI %s: %s', uuid, response)
     return response
 
+def update_change_instance_if_changed(base_url, token, uuid, data, session=None,
+                                      check_mode=False):
+    '''
+    Update the change instance specified by the UUID, unless it already has
+    every value in data and the PUT would change nothing.
+    With check_mode the change instance is only read, never updated.
+    Returns the change instance and whether it was (or would be) updated.
+    '''
+    current = get_change_instance(base_url, token, uuid, session=session)
+    if _has_values(current, data):
+        logger.debug('CI %s is already up to date', uuid)
+        return current, False
+    if check_mode:
+        return current, True
+    return update_change_instance(base_url, token, uuid, data, session=session), True
+
+def bulk_update_change_instances(base_url, token, updates, session=None):
+    '''
+    Update many change instances with a single PATCH.
+    updates is a list of dictionaries, each with the uuid of a change
+    instance and the fields to update.
+    Returns the updated change instances, or None if this NetOrca does not
+    support bulk updates. In that case update_change_instance has to be
+    called for each change instead.
+    '''
+    if base_url in _BULK_UNSUPPORTED:
+        return None
+    session = session or _SESSION
+    url = _endpoint(base_url, _PATH_CHANGE_INSTANCES_BULK)
+    logger.debug('Bulk updating %d CIs: %s', len(updates), updates)
+    response = session.patch(url, **_json_body(session, token, updates))
+    if response.status_code in (404, 405):
+        logger.debug('Bulk update not supported by %s', base_url)
+        _BULK_UNSUPPORTED.add(base_url)
+        return None
+    clear_response_cache()
+    response.raise_for_status()
+    response = _loads(response.content)
+    logger.debug('Bulk updated %d CIs: %s', len(updates), response)
+    return response
+
+def update_change_instances(base_url, token, updates, session=None,
+                            max_batch_size=BULK_BATCH_SIZE,
+                            max_workers=MAX_WORKERS, skip_unchanged=False,
+                            check_mode=False):
+    '''
+    Update many change instances.
+    updates is a list of dictionaries, each with the uuid of a change
+    instance and the fields to update. They are sent to the bulk endpoint in
+    batches of max_batch_size, or with one PUT per change if NetOrca does not
+    support bulk updates, max_workers at a time. A batch that NetOrca
+    rejects is retried with one PUT per change, so that only the changes
+    that fail are reported in failed.
+    If skip_unchanged is True, the change instances that already have the
+    values are left out, their UUIDs are listed in unchanged.
+    With check_mode nothing is updated, count is the number of changes that
+    would be sent.
+    Returns a dictionary with the count of updated changes, the UUIDs that
+    failed, the error for each of those in failures and the change_instances
+    returned by NetOrca.
+    '''
+    result = {
+        'count': 0,
+        'failed': [],
+        'failures': {},
+        'unchanged': [],
+        'change_instances': []
+    }
+    if skip_unchanged:
+        updates = _drop_unchanged(base_url, token, updates, result, session=session,
+                                  max_workers=max_workers)
+    if check_mode:
+        result['count'] = len(updates)
+        return result
+    for start in range(0, len(updates), max_batch_size):
+        batch = updates[start:start + max_batch_size]
+        try:
+            reply = bulk_update_change_instances(base_url, token, batch, session=session)
+        except REQUEST_ERRORS as error:
+            # A rejected token is left to the caller to login again
+            if _is_unauthorized(error):
+                raise
+            logger.error("Bulk update of %d CIs failed: %s", len(batch), error)
+            _update_change_instances(base_url, token, batch, result, session=session,
+                                     max_workers=max_workers)
+            continue
+        if reply is None:
+            # No bulk endpoint, update the remaining changes one by one
+            return _update_change_instances(
+                base_url, token, updates[start:], result, session=session,
+                max_workers=max_workers)
+        result['count'] += len(batch)
+        result['change_instances'].extend(reply)
+    return result
+
+def _drop_unchanged(base_url, token, updates, result, session=None,
+                    max_workers=MAX_WORKERS):
+    '''
+    Return the updates that would change their change instance. The change
+    instances are fetched in parallel, those that already have the values
+    are added to result as unchanged. A change instance that cannot be
+    fetched is added to result as failed, without stopping the others,
+    unless the token was rejected.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(get_change_instance, base_url, token, update['uuid'],
+                            session=session)
+            for update in updates
+        ]
+    pending = []
+    for update, future in zip(updates, futures):
+        try:
+            current = future.result()
+        except Exception as error: # pylint: disable=broad-except
+            if _is_unauthorized(error):
+                raise
+            logger.error("Failed to get CI %s: %s", update['uuid'], error)
+            result['failed'].append(update['uuid'])
+            result['failures'][update['uuid']] = str(error)
+            continue
+        if _has_values(current, update):
+            result['unchanged'].append(update['uuid'])
+            result['change_instances'].append(current)
+        else:
+            pending.append(update)
+    return pending
+
+def _update_change_instances(base_url, token, updates, result, session=None,
+                             max_workers=MAX_WORKERS):
+    '''
+    Update each change instance with its own PUT, in parallel as they do
+    not depend on each other. The count, failed UUIDs with their errors and
+    replies are added to result. A failed update does not stop the others,
+    except a rejected token which is raised for the caller to login again.
+    '''
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for update in updates:
+            data = {key: value for key, value in update.items() if key != 'uuid'}
+            future = executor.submit(
+                update_change_instance,
+                base_url,
+                token,
+                update['uuid'],
+                data,
+                session=session
+            )
+            futures[future] = update['uuid']
+        for future in as_completed(futures):
+            try:
+                result['change_instances'].append(future.result())
+                result['count'] += 1
+            except Exception as error: # pylint: disable=broad-except
+                if _is_unauthorized(error):
+                    raise
+                logger.error("Failed to update CI %s: %s", futures[future], error)
+                result['failed'].append(futures[future])
+                result['failures'][futures[future]] = str(error)
+    return result
+
 # Complete all pending change_instances
 
-def complete_change_instances(base_url, token, service_name, deployed_item=None):
+def complete_change_instances(base_url, token, service_name, deployed_item=None,
+                              session=None, max_workers=MAX_WORKERS,
+                              check_mode=False, filter_locally=FILTER_SERVICE_LOCALLY):
     '''
     Complete all the change instances that are approved for the given
-    service_name.
+    service_name, updating up to max_workers of them at a time.
+    With check_mode the approved changes are counted but not updated.
+    With filter_locally False only the uuid of each change is requested,
+    and NetOrca is trusted to filter on service_name.
+    All the calls share one session so the connection to NetOrca is reused.
     '''
+    session = session or _SESSION
     result = {
         'count': 0,
         'msg': 'Starting',
-        'successful': False
+        'successful': False,
+        'failed': [],
+        'failures': {}
     }
     # Get all change instances for given service_name
     approved_changes = get_change_instances(
         base_url,
         token,
         state=const.NETORCA_STATES_APPROVED,
-        service_name=service_name
+        service_name=service_name,
+        session=session,
+        fields=_completion_fields(filter_locally),
+        filter_locally=filter_locally
     )
-    # Complete the change
-    for change in approved_changes:
-        # Change state to Completed
-        data = {
-                'state': const.NETORCA_STATES_COMPLETED,
-                'deployed_item': deployed_item
-            }
-        logging.debug("Completing CI %s",change['uuid'])
-        update_change_instance(
-            base_url,
-            token,
-            change['uuid'],
-            data    
-        )
-        result['count'] += 1
-    # TODO return success or not?
+    if not approved_changes:
+        return _no_changes_result(result)
+    if check_mode:
+        result['count'] = len(approved_changes)
+        result['successful'] = True
+        result['msg'] = f"Would complete {result['count']} changes"
+        return result
+    # All the pages are fetched before updating, completing a change removes
+    # it from the APPROVED results and would shift the later pages.
+    updates = [
+        {
+            'uuid': change['uuid'],
+            'state': const.NETORCA_STATES_COMPLETED,
+            'deployed_item': deployed_item
+        }
+        for change in approved_changes
+    ]
+    reply = update_change_instances(base_url, token, updates, session=session,
+                                    max_workers=max_workers)
+    result['count'] = reply['count']
+    result['failed'] = reply['failed']
+    result['failures'] = reply['failures']
+    return _completed_result(result)
+
+def _no_changes_result(result):
+    ''' Set the outcome of a complete_change_instances run with nothing to do '''
     result['successful'] = True
+    result['msg'] = 'No approved changes'
+    return result
+
+def _completed_result(result):
+    ''' Set the outcome and message of a complete_change_instances result '''
+    result['successful'] = not result['failed']
     result['msg'] = f"Completed {result['count']} changes"
+    if result['failed']:
+        result['msg'] += f", failed to complete {len(result['failed'])}: {result['failed']}"
     return result
+
+# Async variants, these require aiohttp. It is imported only when they
+# are used, as loading it would slow down the start of every module.
+
+async def a_login(session, base_url, username, password, use_cache=True,
+                  save_token=True):
+    '''
+    Async version of login, using the same token cache.
+    Logging in through the session that makes the later calls lets them
+    reuse the connection opened for the login.
+    '''
+    token, _ = await _a_login(session, base_url, username, password,
+                              use_cache=use_cache, save_token=save_token)
+    return token
+
+async def _a_login(session, base_url, username, password, use_cache=True,
+                   save_token=True):
+    ''' a_login, returning the token and whether it came from the cache '''
+    if use_cache:
+        token = _cached_token(base_url, username)
+        if token:
+            logger.debug('Using cached token')
+            return token, True
+    url = _endpoint(base_url, _PATH_LOGIN)
+    data = {
+        "username": username,
+        "password": password
+         }
+    # Never send a previous, possibly rejected, token when logging in
+    session.headers.pop('Authorization', None)
+    async with session.post(url, json=data) as response:
+        token = (await response.json(loads=_loads))['token']
+    if save_token:
+        _cache_token(base_url, username, token)
+    return token, False
+
+async def a_get_change_instances(session, base_url, state='', service_name='', fields=None,
+                                 filter_locally=FILTER_SERVICE_LOCALLY):
+    '''
+    Async version of get_change_instances.
+    The session should be an aiohttp.ClientSession with the Authorization
+    header already set.
+    '''
+    url = _endpoint(base_url, _PATH_CHANGE_INSTANCES)
+    params = dict(_change_instance_params(state, service_name, fields), page_size=_PAGE_SIZE)
+    changes = []
+    while url:
+        async with session.get(url, params=params) as response:
+            body = await response.json(loads=_loads)
+        changes.extend(body.get('results') or ())
+        url = body.get('next')
+        params = None
+    if service_name and filter_locally:
+        return filter_change_instances(changes, service=service_name)
+    return changes
+
+async def a_update_change_instance(session, base_url, uuid, data, semaphore=None):
+    '''
+    Async version of update_change_instance.
+    If a semaphore is given it is held for the duration of the request.
+    '''
+    url = _change_instance_url(base_url, uuid)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(1)
+    async with semaphore:
+        async with session.put(url, json=data) as response:
+            return await response.json(loads=_loads)
+
+async def a_complete_change_instances(base_url, token, service_name, deployed_item=None,
+                                      concurrency=_ASYNC_CONCURRENCY,
+                                      username=None, password=None, token_cache=True,
+                                      filter_locally=FILTER_SERVICE_LOCALLY):
+    '''
+    Async version of complete_change_instances.
+    All the updates are in flight together on one event loop, at most
+    concurrency of them at a time.
+    If token is None, login with the username and password on the same
+    session first. Like call_authenticated, a cached token that NetOrca
+    rejects is forgotten and the login retried once. With token_cache False
+    the on-disk token cache is neither read nor written.
+    '''
+    try:
+        import aiohttp # pylint: disable=import-outside-toplevel
+    except ImportError as error:
+        raise ImportError("aiohttp is required for the async NetOrca helpers") from error
+    result = {
+        'count': 0,
+        'msg': 'Starting',
+        'successful': False,
+        'failed': [],
+        'failures': {}
+    }
+    data = {
+            'state': const.NETORCA_STATES_COMPLETED,
+            'deployed_item': deployed_item
+        }
+    connector = aiohttp.TCPConnector(limit=concurrency, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+            raise_for_status=True
+        ) as session:
+        from_cache = False
+        if not token:
+            token, from_cache = await _a_login(session, base_url, username, password,
+                                               use_cache=token_cache,
+                                               save_token=token_cache)
+        session.headers['Authorization'] = f'Token {token}'
+        try:
+            approved_changes = await _a_get_approved_changes(session, base_url, service_name,
+                                                             filter_locally)
+        except aiohttp.ClientResponseError as error:
+            # Only a token from the cache can be stale, a fresh one is not retried
+            if not from_cache or error.status != 401:
+                raise
+            logger.debug('Token rejected, logging in again')
+            forget_token(base_url, username)
+            token, _ = await _a_login(session, base_url, username, password,
+                                      use_cache=False)
+            session.headers['Authorization'] = f'Token {token}'
+            approved_changes = await _a_get_approved_changes(session, base_url, service_name,
+                                                             filter_locally)
+        if not approved_changes:
+            return _no_changes_result(result)
+        semaphore = asyncio.Semaphore(concurrency)
+        replies = await asyncio.gather(
+            *[
+                a_update_change_instance(session, base_url, change['uuid'], data, semaphore)
+                for change in approved_changes
+            ],
+            return_exceptions=True
+        )
+    for change, reply in zip(approved_changes, replies):
+        if isinstance(reply, Exception):
+            logger.error("Failed to complete CI %s: %s", change['uuid'], reply)
+            result['failed'].append(change['uuid'])
+            result['failures'][change['uuid']] = str(reply)
+        else:
+            result['count'] += 1
+    return _completed_result(result)
+
+async def _a_get_approved_changes(session, base_url, service_name,
+                                  filter_locally=FILTER_SERVICE_LOCALLY):
+    ''' Get the approved change instances with the fields needed to complete them '''
+    return await a_get_change_instances(
+        session,
+        base_url,
+        state=const.NETORCA_STATES_APPROVED,
+        service_name=service_name,
+        fields=_completion_fields(filter_locally),
+        filter_locally=filter_locally
+    )
+
+def complete_change_instances_async(base_url, token, service_name, deployed_item=None,
+                                    concurrency=_ASYNC_CONCURRENCY,
+                                    username=None, password=None, token_cache=True,
+                                    filter_locally=FILTER_SERVICE_LOCALLY):
+    '''
+    Blocking wrapper that runs a_complete_change_instances on a new event
+    loop, for callers such as Ansible modules that are not async.
+    '''
+    return asyncio.run(
+        a_complete_change_instances(
+            base_url,
+            token,
+            service_name,
+            deployed_item=deployed_item,
+            concurrency=concurrency,
+            username=username,
+            password=password,
+            token_cache=token_cache,
+            filter_locally=filter_locally
+        )
+    )
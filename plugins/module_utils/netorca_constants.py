@@ -1,6 +1,8 @@
 ''''
 Contains the Constants used by ansible modules
 '''
+import re
+
 NETORCA_STATES_REJECTED = 'REJECTED'
 NETORCA_STATES_PENDING = 'PENDING'
 NETORCA_STATES_APPROVED = 'APPROVED'
@@ -11,6 +13,8 @@ NETORCA_VALID_STATES = [
     NETORCA_STATES_APPROVED,
     NETORCA_STATES_COMPLETED
 ]
+# For membership tests, the list above keeps the states in order for messages
+NETORCA_VALID_STATES_SET = frozenset(NETORCA_VALID_STATES)
 
 FIELDS_URL = 'url'
 FIELDS_USER = 'username'
@@ -20,3 +24,14 @@ FIELDS_STATE = 'state'
 FIELDS_SERVICE = 'service_name'
 FIELDS_UUID = 'uuid'
 FIELDS_DEPLOYED_ITEM = 'deployed_item'
+FIELDS_CHANGES = 'changes'
+FIELDS_MAX_BATCH_SIZE = 'max_batch_size'
+FIELDS_CONCURRENCY = 'concurrency'
+FIELDS_TOKEN_CACHE = 'token_cache'
+FIELDS_DESCRIPTION = 'description'
+FIELDS_SKIP_UNCHANGED = 'skip_if_unchanged'
+FIELDS_TIMEOUT = 'timeout'
+FIELDS_FILTER_LOCALLY = 'filter_service_locally'
+
+# Compiled once, much cheaper to import and match than the validators package
+URL_RE = re.compile(r'^https?://[^\s/$.?#][^\s]*$')
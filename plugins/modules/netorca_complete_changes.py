@@ -9,24 +9,25 @@ Copyright: (c) 2022, NetAutomate <info@netautomate.org>
 from __future__ import (absolute_import, division, print_function)
 
 import logging
-from typing_extensions import Required
-from validators import url as url_valid
 from ansible.module_utils.basic import AnsibleModule # pylint: disable=import-error
 try:
     # Try to import the module from the local folder
-    from module_utils.netorca_base import login, complete_change_instances
+    from module_utils.netorca_base import call_authenticated, complete_change_instances, \
+        build_session, ensure_logger, REQUEST_ERRORS, TIMEOUT, MAX_WORKERS, FILTER_SERVICE_LOCALLY
     from module_utils.netorca_constants import FIELDS_SERVICE, FIELDS_API_KEY, \
-     FIELDS_PASS, FIELDS_USER, FIELDS_URL, FIELDS_DEPLOYED_ITEM
+     FIELDS_PASS, FIELDS_TOKEN_CACHE, FIELDS_TIMEOUT, FIELDS_USER, FIELDS_URL, URL_RE, FIELDS_DEPLOYED_ITEM, \
+     FIELDS_CONCURRENCY, FIELDS_FILTER_LOCALLY
 except ModuleNotFoundError:
     # If that failed, we are probably running inside a playbook
     # so the ansible namespace needs to be used.
-    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_base import login, update_change_instance
-    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_constants import NETORCA_STATES_APPROVED,  \
-         FIELDS_PASS, FIELDS_USER, FIELDS_URL, FIELDS_STATE, FIELDS_UUID, \
-             FIELDS_DEPLOYED_ITEM, NETORCA_VALID_STATES, FIELDS_API_KEY
+    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_base import call_authenticated, complete_change_instances, \
+        build_session, ensure_logger, REQUEST_ERRORS, TIMEOUT, MAX_WORKERS, FILTER_SERVICE_LOCALLY
+    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_constants import FIELDS_SERVICE, FIELDS_API_KEY, \
+     FIELDS_PASS, FIELDS_TOKEN_CACHE, FIELDS_TIMEOUT, FIELDS_USER, FIELDS_URL, URL_RE, FIELDS_DEPLOYED_ITEM, \
+     FIELDS_CONCURRENCY, FIELDS_FILTER_LOCALLY
 
 
-logging.basicConfig(filename='netorca_update_change.log',level=logging.DEBUG)
+logger = logging.getLogger('netorca')
 
 __metaclass__ = type
 
@@ -63,11 +64,37 @@ options:
             available.
         required: false
         type: str
+    token_cache:
+        description : Reuse the token from an earlier login with the same url \
+            and username, kept for up to 50 minutes in \
+            ~/.cache/netorca/token.json. Set to false to login on every run.
+        required: false
+        type: bool
+        default: true
+    timeout:
+        description : Seconds to wait for NetOrca to connect or reply to each \
+            request before failing.
+        required: false
+        type: float
+        default: 10.0
     service_name:
         description : The name of the service for which all change instances \
             should be marked as complete
         required: true
         type: str
+    concurrency:
+        description : The most change instances updated at the same time when \
+            NetOrca does not support bulk updates.
+        required: false
+        type: int
+        default: 8
+    filter_service_locally:
+        description : Check the service of each approved change again after \
+            NetOrca filtered them on service_name, for servers that ignore \
+            that filter. Set to false to request only the uuid of each change.
+        required: false
+        type: bool
+        default: true
 
     
 # Specify this value according to your collection
@@ -105,48 +132,55 @@ message:
     description: A general message, useful when errors are encountered
     type: str
     returned: always
+failures:
+    description: The error for each change instance that could not be updated
+    type: dict
+    returned: when some change instances could not be updated
 '''
 
 
 FIELDS = {
-        FIELDS_URL: dict(type='str', required=True),
-        FIELDS_API_KEY: dict(type='str', required=False, no_log=True),
-        FIELDS_USER: dict(type='str', required=False),
-        FIELDS_PASS: dict(type='str', required=False, no_log=True),
-        FIELDS_SERVICE: dict(type='str', required=True),
-        FIELDS_DEPLOYED_ITEM: dict(tyep='dict', required=True)
+        FIELDS_URL: {'type': 'str', 'required': True},
+        FIELDS_API_KEY: {'type': 'str', 'required': False, 'no_log': True},
+        FIELDS_USER: {'type': 'str', 'required': False},
+        FIELDS_PASS: {'type': 'str', 'required': False, 'no_log': True},
+        FIELDS_TOKEN_CACHE: {'type': 'bool', 'required': False, 'default': True},
+        FIELDS_TIMEOUT: {'type': 'float', 'required': False, 'default': TIMEOUT},
+        FIELDS_SERVICE: {'type': 'str', 'required': True},
+        FIELDS_DEPLOYED_ITEM: {'type': 'dict', 'required': True},
+        FIELDS_CONCURRENCY: {'type': 'int', 'required': False, 'default': MAX_WORKERS},
+        FIELDS_FILTER_LOCALLY: {'type': 'bool', 'required': False,
+                                'default': FILTER_SERVICE_LOCALLY}
 }
 
-def fail_module(module, msg):
+def fail_module(module, msg, **extra):
     result = {
         'message': msg,
+        **extra
     }
-    logging.error(msg)
+    logger.error(msg)
     module.fail_json(msg=msg, **result)
 
 def validate_params(module):
     params = module.params
-    keys = params.keys()
-    valid = True
-    # Check that either api_key or username + password supplied
-    if not FIELDS_API_KEY in keys:
-        if not ( FIELDS_USER in keys and FIELDS_PASS in keys):
-            valid = False
-            fail_module(
-                module,
-                "If no api_key specified, username and passowrd required"
-            )
+    # Check that either api_key or username + password supplied. Ansible sets
+    # every option that is not given to None, so the values are checked
+    if not params.get(FIELDS_API_KEY) and \
+            not (params.get(FIELDS_USER) and params.get(FIELDS_PASS)):
+        fail_module(
+            module,
+            "If no api_key specified, username and passowrd required"
+        )
 
     # Check that URL is a valid URL
-    if not url_valid(params[FIELDS_URL]):
-        valid = False
+    if not URL_RE.match(params[FIELDS_URL]):
         fail_module(module, f"{params[FIELDS_URL]} is not a valid url")
-    # Check that State is one of valid states
-
-    if not FIELDS_SERVICE in keys or not params[FIELDS_SERVICE]:
-        valid = False
+    # Check that at least one change instance is updated at a time
+    if params.get(FIELDS_CONCURRENCY) is not None and params[FIELDS_CONCURRENCY] < 1:
+        fail_module(module, f"{FIELDS_CONCURRENCY} must be at least 1")
+    # Check that a service name is given
+    if not params.get(FIELDS_SERVICE):
         fail_module(module, f"Missing {FIELDS_SERVICE}")
-    return valid
 
 
 def run_module(module):
@@ -158,34 +192,42 @@ def run_module(module):
         message=''
     )
 
-    # Validate input
-    if validate_params(module):
-
-        # Login
-        if FIELDS_API_KEY not in module.params or not module.params[FIELDS_API_KEY]:
-            api_key = login(
-                module.params[FIELDS_URL],
-                module.params[FIELDS_USER],
-                module.params[FIELDS_PASS]
+    # Validate input, bad options end the module in fail_module
+    validate_params(module)
+    params = module.params
+    # One session for every call so the connection is reused
+    try:
+        with build_session(max_workers=params[FIELDS_CONCURRENCY],
+                           timeout=params[FIELDS_TIMEOUT]) as session:
+            # Login if no API key is given, then complete the changes
+            reply = call_authenticated(
+                    complete_change_instances,
+                    base_url=params[FIELDS_URL],
+                    token=params[FIELDS_API_KEY],
+                    username=params[FIELDS_USER],
+                    password=params[FIELDS_PASS],
+                    token_cache=params[FIELDS_TOKEN_CACHE],
+                    session=session,
+                    service_name= params[FIELDS_SERVICE],
+                    deployed_item= params[FIELDS_DEPLOYED_ITEM],
+                    max_workers= params[FIELDS_CONCURRENCY],
+                    filter_locally= params[FIELDS_FILTER_LOCALLY],
+                    # Only the approved changes are read in check mode
+                    check_mode= module.check_mode
             )
-        else:
-            api_key = module.params[FIELDS_API_KEY]
-
-        reply = complete_change_instances(
-                base_url=module.params[FIELDS_URL],
-                token=api_key,
-                service_name= module.params[FIELDS_SERVICE],
-                deployed_item= module.params[FIELDS_DEPLOYED_ITEM] 
-        )
-        if not reply['successful']:
-            fail_module(module, reply['msg'])
-        if reply['count'] > 0:
-            result['changed']= True
-        result['message']= reply['msg']
+    except REQUEST_ERRORS as error:
+        fail_module(module, f"Request to NetOrca failed: {error}")
+    if not reply['successful']:
+        fail_module(module, reply['msg'], failures=reply['failures'])
+    if reply['count'] > 0:
+        result['changed']= True
+    result['message']= reply['msg']
 
-        module.exit_json(**result)
+    module.exit_json(**result)
 
 def main():
+    # Only sets up logging when NETORCA_DEBUG_LOG asks for a debug log
+    ensure_logger()
     module = AnsibleModule(
         argument_spec=FIELDS,
         supports_check_mode=True
@@ -15,26 +15,27 @@ from __future__ import (absolute_import, division, print_function)
 
 import logging
 
-from validators import url as url_valid
 from ansible.module_utils.basic import AnsibleModule # pylint: disable=import-error
 try:
     # Try to import the module from the local folder
-    from module_utils.netorca_base import login, get_change_instances
+    from module_utils.netorca_base import call_authenticated, get_change_instances, \
+        build_session, ensure_logger, REQUEST_ERRORS, TIMEOUT
     from module_utils.netorca_constants import FIELDS_API_KEY, \
-         FIELDS_PASS, FIELDS_USER, FIELDS_URL, FIELDS_STATE, \
-            NETORCA_VALID_STATES, NETORCA_STATES_APPROVED
+         FIELDS_PASS, FIELDS_TOKEN_CACHE, FIELDS_TIMEOUT, FIELDS_USER, FIELDS_URL, URL_RE, FIELDS_STATE, \
+            NETORCA_VALID_STATES, NETORCA_VALID_STATES_SET, NETORCA_STATES_APPROVED
 except ModuleNotFoundError:
     # If that failed, we are probably running inside a playbook
     # so the ansible namespace needs to be used.
-    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_base import login, get_change_instances
-    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_constants import NETORCA_STATES_APPROVED,  \
-         FIELDS_PASS, FIELDS_USER, FIELDS_URL, FIELDS_STATE, FIELDS_UUID, \
-             FIELDS_DEPLOYED_ITEM, NETORCA_VALID_STATES, FIELDS_API_KEY
+    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_base import call_authenticated, get_change_instances, \
+        build_session, ensure_logger, REQUEST_ERRORS, TIMEOUT
+    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_constants import FIELDS_API_KEY, \
+         FIELDS_PASS, FIELDS_TOKEN_CACHE, FIELDS_TIMEOUT, FIELDS_USER, FIELDS_URL, URL_RE, FIELDS_STATE, \
+            NETORCA_VALID_STATES, NETORCA_VALID_STATES_SET, NETORCA_STATES_APPROVED
 
 
 __metaclass__ = type
 
-logging.basicConfig(filename='netroca_update_change.log',level=logging.DEBUG)
+logger = logging.getLogger('netorca')
 
 DOCUMENTATION = r'''
 ---
@@ -68,6 +69,19 @@ options:
             available.
         required: false
         type: str
+    token_cache:
+        description : Reuse the token from an earlier login with the same url \
+            and username, kept for up to 50 minutes in \
+            ~/.cache/netorca/token.json. Set to false to login on every run.
+        required: false
+        type: bool
+        default: true
+    timeout:
+        description : Seconds to wait for NetOrca to connect or reply to each \
+            request before failing.
+        required: false
+        type: float
+        default: 10.0
     state:
         description : One of 'PENDING', 'ACCEPTED', 'COMPLETED'
         required: false
@@ -119,46 +133,46 @@ RESULT_FIELD_MESSAGE = 'message'
 RESULT_FIELD_CHANGED = 'changed'
 
 FIELDS = {
-        FIELDS_URL: dict(type='str', required=True),
-        FIELDS_API_KEY: dict(type='str', required=False, no_log=True),
-        FIELDS_USER: dict(type='str', required=False),
-        FIELDS_PASS: dict(type='str', required=False, no_log=True),
-        FIELDS_STATE: dict(type='str', required=False)
+        FIELDS_URL: {'type': 'str', 'required': True},
+        FIELDS_API_KEY: {'type': 'str', 'required': False, 'no_log': True},
+        FIELDS_USER: {'type': 'str', 'required': False},
+        FIELDS_PASS: {'type': 'str', 'required': False, 'no_log': True},
+        FIELDS_TOKEN_CACHE: {'type': 'bool', 'required': False, 'default': True},
+        FIELDS_TIMEOUT: {'type': 'float', 'required': False, 'default': TIMEOUT},
+        FIELDS_STATE: {'type': 'str', 'required': False}
 }
 
 def fail_module(module, msg):
     result = {
         'change_instances': []
     }
-    logging.error(msg)
+    logger.error(msg)
     module.fail_json(msg=msg, **result)
 
 def validate_params(module):
     params = module.params
-    keys = params.keys()
-    valid = True
-    # Check that either api_key or username + password supplied
-    if not FIELDS_API_KEY in keys:
-        if not ( FIELDS_USER in keys and FIELDS_PASS in keys):
-            valid = False
-            fail_module(
-                module,
-                "If no api_key specified, username and passowrd required"
-            )
+    # Check that either api_key or username + password supplied. Ansible sets
+    # every option that is not given to None, so the values are checked
+    if not params.get(FIELDS_API_KEY) and \
+            not (params.get(FIELDS_USER) and params.get(FIELDS_PASS)):
+        fail_module(
+            module,
+            "If no api_key specified, username and passowrd required"
+        )
 
     # Check that URL is a valid URL
-    if not url_valid(params[FIELDS_URL]):
-        valid = False
+    if not URL_RE.match(params[FIELDS_URL]):
         fail_module(module, f"{params[FIELDS_URL]} is not a valid url")
-   # Check that State is one of valid states
-    if FIELDS_STATE in keys:
-        if not params[FIELDS_STATE] in NETORCA_VALID_STATES:
-            valid = False
-            fail_module(
-                module,
-                f"{params[FIELDS_STATE]} is not one of {NETORCA_VALID_STATES}"
-            )
-    return valid
+    # Check that State is one of valid states, in any case
+    state = (params.get(FIELDS_STATE) or '').upper()
+    if state and state not in NETORCA_VALID_STATES_SET:
+        fail_module(
+            module,
+            f"{params[FIELDS_STATE]} is not one of {NETORCA_VALID_STATES}"
+        )
+    if state:
+        # NetOrca expects the states in upper case
+        params[FIELDS_STATE] = state
 
 def run_module(module):
     # define available arguments/parameters a user can pass to the module
@@ -170,41 +184,39 @@ def run_module(module):
         RESULT_FIELD_MESSAGE: 'Starting Module'
     }
 
-    logging.debug(module.params)
-
-    # Validate input
-    if validate_params(module):
-
-        # Login
-        if FIELDS_API_KEY not in module.params or not module.params[FIELDS_API_KEY]:
-            logging.debug('No API key provided, logging in')
-            api_key = login(
-                module.params[FIELDS_URL],
-                module.params[FIELDS_USER],
-                module.params[FIELDS_PASS]
-            )
-        else:
-            logging.debug('API key provided, skipping logging in')
-            api_key = module.params[FIELDS_API_KEY]
-
-        state = NETORCA_STATES_APPROVED
-        # Get instances
-        if FIELDS_STATE in module.params.keys() and module.params[FIELDS_STATE]:
-            state = module.params[FIELDS_STATE]
-
-        result[RESULT_FIELD_CHANGES] = get_change_instances(
-            base_url=module.params[FIELDS_URL],
-            token=api_key,
-            state=state
-            )
-
-
-        result[RESULT_FIELD_MESSAGE]= f"Found {len(result[RESULT_FIELD_CHANGES])} change items"
-
-        logging.debug(result)
-        module.exit_json(**result)
+    # Validate input, bad options end the module in fail_module
+    validate_params(module)
+    params = module.params
+    # Get instances
+    state = params[FIELDS_STATE] or NETORCA_STATES_APPROVED
+
+    # One session for every call so the connection is reused
+    try:
+        with build_session(timeout=params[FIELDS_TIMEOUT]) as session:
+            # Login if no API key is given, then get the instances
+            result[RESULT_FIELD_CHANGES] = call_authenticated(
+                get_change_instances,
+                base_url=params[FIELDS_URL],
+                token=params[FIELDS_API_KEY],
+                username=params[FIELDS_USER],
+                password=params[FIELDS_PASS],
+                token_cache=params[FIELDS_TOKEN_CACHE],
+                session=session,
+                state=state
+                )
+    except REQUEST_ERRORS as error:
+        fail_module(module, f"Request to NetOrca failed: {error}")
+
+
+    result[RESULT_FIELD_MESSAGE]= f"Found {len(result[RESULT_FIELD_CHANGES])} change items"
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Result %s', result)
+    module.exit_json(**result)
 
 def main():
+    # Only sets up logging when NETORCA_DEBUG_LOG asks for a debug log
+    ensure_logger()
     module = AnsibleModule(
         argument_spec=FIELDS,
         supports_check_mode=True
@@ -8,25 +8,32 @@ Copyright: (c) 2022, NetAutomate <info@netautomate.org>
 from __future__ import (absolute_import, division, print_function)
 
 import logging
-from validators import url as url_valid
 from ansible.module_utils.basic import AnsibleModule # pylint: disable=import-error
 try:
     # Try to import the module from the local folder
-    from module_utils.netorca_base import login, update_change_instance
+    from module_utils.netorca_base import call_authenticated, update_change_instance, \
+        update_change_instance_if_changed, update_change_instances, build_session, ensure_logger, REQUEST_ERRORS, TIMEOUT, BULK_BATCH_SIZE, \
+        MAX_WORKERS
     from module_utils.netorca_constants import FIELDS_API_KEY, \
-         FIELDS_PASS, FIELDS_USER, FIELDS_URL, FIELDS_STATE, FIELDS_UUID, \
-             FIELDS_DEPLOYED_ITEM, NETORCA_VALID_STATES
+         FIELDS_PASS, FIELDS_TOKEN_CACHE, FIELDS_TIMEOUT, FIELDS_USER, FIELDS_URL, URL_RE, FIELDS_STATE, FIELDS_UUID, \
+             FIELDS_DEPLOYED_ITEM, NETORCA_VALID_STATES, NETORCA_VALID_STATES_SET, FIELDS_CHANGES, \
+                 FIELDS_MAX_BATCH_SIZE, FIELDS_CONCURRENCY, \
+                 FIELDS_DESCRIPTION, FIELDS_SKIP_UNCHANGED
 except ModuleNotFoundError:
     # If that failed, we are probably running inside a playbook
     # so the ansible namespace needs to be used.
-    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_base import login, update_change_instance
-    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_constants import NETORCA_STATES_APPROVED,  \
-         FIELDS_PASS, FIELDS_USER, FIELDS_URL, FIELDS_STATE, FIELDS_UUID, \
-             FIELDS_DEPLOYED_ITEM, NETORCA_VALID_STATES, FIELDS_API_KEY
+    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_base import call_authenticated, update_change_instance, \
+        update_change_instance_if_changed, update_change_instances, build_session, ensure_logger, REQUEST_ERRORS, TIMEOUT, BULK_BATCH_SIZE, \
+        MAX_WORKERS
+    from ansible_collections.netorca.netorca_tools.plugins.module_utils.netorca_constants import FIELDS_API_KEY, \
+         FIELDS_PASS, FIELDS_TOKEN_CACHE, FIELDS_TIMEOUT, FIELDS_USER, FIELDS_URL, URL_RE, FIELDS_STATE, FIELDS_UUID, \
+             FIELDS_DEPLOYED_ITEM, NETORCA_VALID_STATES, NETORCA_VALID_STATES_SET, FIELDS_CHANGES, \
+                 FIELDS_MAX_BATCH_SIZE, FIELDS_CONCURRENCY, \
+                 FIELDS_DESCRIPTION, FIELDS_SKIP_UNCHANGED
 
 __metaclass__ = type
 
-logging.basicConfig(filename='netorca_update_change.log',level=logging.DEBUG)
+logger = logging.getLogger('netorca')
 
 DOCUMENTATION = r'''
 ---
@@ -60,20 +67,66 @@ options:
             available.
         required: false
         type: str
+    token_cache:
+        description : Reuse the token from an earlier login with the same url \
+            and username, kept for up to 50 minutes in \
+            ~/.cache/netorca/token.json. Set to false to login on every run.
+        required: false
+        type: bool
+        default: true
+    timeout:
+        description : Seconds to wait for NetOrca to connect or reply to each \
+            request before failing.
+        required: false
+        type: float
+        default: 10.0
     state:
         description : The final state that the change should be in
-            available.
-        required: true
+            available. Required unless changes is given.
+        required: false
         type: str
     uuid: 
         description : UUID for the change instance that should be updated
-            available.
-        required: true
+            available. Required unless changes is given.
+        required: false
         type: str
     deployed_item:
         description : A dictionary that contains all the deployed_item values
         required: false
         type: dict
+    description:
+        description : A dictionary to set as the description of the change \
+            instance given by uuid. Left unchanged when not given.
+        required: false
+        type: dict
+    changes:
+        description : A list of change instances to update together, each a \
+            dictionary with a uuid, a state and optionally a description and \
+            a deployed_item. Use instead of uuid and state.
+        required: false
+        type: list
+        elements: dict
+    max_batch_size:
+        description : The most change instances sent to NetOrca in one bulk \
+            update when changes is given.
+        required: false
+        type: int
+        default: 50
+    skip_if_unchanged:
+        description : Read each change instance first and do not update the \
+            ones that already have the given state and values. In check mode \
+            the change instances are still read, so that changed is only \
+            reported for those that would be updated. Without it check mode \
+            sends nothing to NetOrca and always reports changed.
+        required: false
+        type: bool
+        default: false
+    concurrency:
+        description : The most change instances updated at the same time when \
+            NetOrca does not support bulk updates.
+        required: false
+        type: int
+        default: 8
 
     
 # Specify this value according to your collection
@@ -101,6 +154,20 @@ EXAMPLES = r'''
     state: COMPLETED
     uuid: <long uuid>
 
+- name: Set several changes to completed at once
+  netorca_update_change:
+    url: https://dev.netorca.io
+    api_key: <api key here>
+    changes:
+      - uuid: <long uuid>
+        state: COMPLETED
+      - uuid: <another long uuid>
+        state: COMPLETED
+        description:
+          note: deployed by ansible
+        deployed_item:
+          ip: 10.0.0.1
+
 '''
 
 RETURN = r'''
@@ -113,54 +180,93 @@ message:
     description: A general message, useful when errors are encountered
     type: str
     returned: always
+change_instances:
+    description: The updated change instances when changes is given
+    type: list
+    returned: when changes is given
+failures:
+    description: The error for each change instance that could not be updated
+    type: dict
+    returned: when some change instances could not be updated
 '''
 
 
 FIELDS = {
-        FIELDS_URL: dict(type='str', required=True),
-        FIELDS_API_KEY: dict(type='str', required=False, no_log=True),
-        FIELDS_USER: dict(type='str', required=False),
-        FIELDS_PASS: dict(type='str', required=False, no_log=True),
-        FIELDS_STATE: dict(type='str', required=True),
-        FIELDS_UUID: dict(type='str', required=True),
-        FIELDS_DEPLOYED_ITEM: dict(type='dict', required=False)
+        FIELDS_URL: {'type': 'str', 'required': True},
+        FIELDS_API_KEY: {'type': 'str', 'required': False, 'no_log': True},
+        FIELDS_USER: {'type': 'str', 'required': False},
+        FIELDS_PASS: {'type': 'str', 'required': False, 'no_log': True},
+        FIELDS_TOKEN_CACHE: {'type': 'bool', 'required': False, 'default': True},
+        FIELDS_TIMEOUT: {'type': 'float', 'required': False, 'default': TIMEOUT},
+        FIELDS_STATE: {'type': 'str', 'required': False},
+        FIELDS_UUID: {'type': 'str', 'required': False},
+        FIELDS_DEPLOYED_ITEM: {'type': 'dict', 'required': False},
+        FIELDS_DESCRIPTION: {'type': 'dict', 'required': False},
+        FIELDS_CHANGES: {'type': 'list', 'elements': 'dict', 'required': False},
+        FIELDS_MAX_BATCH_SIZE: {'type': 'int', 'required': False,
+                                'default': BULK_BATCH_SIZE},
+        FIELDS_CONCURRENCY: {'type': 'int', 'required': False, 'default': MAX_WORKERS},
+        FIELDS_SKIP_UNCHANGED: {'type': 'bool', 'required': False, 'default': False}
 }
 
-def fail_module(module, msg):
+def fail_module(module, msg, **extra):
     result = {
         'meesage': msg,
-        'change_instances': []
+        'change_instances': [],
+        **extra
     }
-    logging.error(msg)
+    logger.error(msg)
     module.fail_json(msg=msg, **result)
 
 def validate_params(module):
     params = module.params
-    keys = params.keys()
-    valid = True
-    # Check that either api_key or username + password supplied
-    if not FIELDS_API_KEY in keys:
-        if not ( FIELDS_USER in keys and FIELDS_PASS in keys):
-            valid = False
-            fail_module(
-                module,
-                "If no api_key specified, username and passowrd required"
-            )
+    # Check that either api_key or username + password supplied. Ansible sets
+    # every option that is not given to None, so the values are checked
+    if not params.get(FIELDS_API_KEY) and \
+            not (params.get(FIELDS_USER) and params.get(FIELDS_PASS)):
+        fail_module(
+            module,
+            "If no api_key specified, username and passowrd required"
+        )
 
     # Check that URL is a valid URL
-    if not url_valid(params[FIELDS_URL]):
-        valid = False
+    if not URL_RE.match(params[FIELDS_URL]):
         fail_module(module, f"{params[FIELDS_URL]} is not a valid url")
-   # Check that State is one of valid states
-    if FIELDS_STATE in keys:
-        if not params[FIELDS_STATE] in NETORCA_VALID_STATES:
-            valid = False
-            fail_module(
-                module,
-                f"{params[FIELDS_STATE]} is not one of {NETORCA_VALID_STATES}")
+    # Check that at least one change instance is updated at a time
+    if params.get(FIELDS_CONCURRENCY) is not None and params[FIELDS_CONCURRENCY] < 1:
+        fail_module(module, f"{FIELDS_CONCURRENCY} must be at least 1")
+    # Check that the batches hold at least one change
+    if params.get(FIELDS_MAX_BATCH_SIZE) is not None and params[FIELDS_MAX_BATCH_SIZE] < 1:
+        fail_module(module, f"{FIELDS_MAX_BATCH_SIZE} must be at least 1")
+    # Check that either one change or a list of changes is supplied
+    if params.get(FIELDS_CHANGES):
+        for change in params[FIELDS_CHANGES]:
+            change_state = change.get(FIELDS_STATE)
+            # The suboptions are not declared, so a state can be any type
+            change_state = change_state.upper() if isinstance(change_state, str) else ''
+            if not change.get(FIELDS_UUID) or \
+                    change_state not in NETORCA_VALID_STATES_SET:
+                fail_module(
+                    module,
+                    f"Each of {FIELDS_CHANGES} needs a {FIELDS_UUID} and a "
+                    f"{FIELDS_STATE} from {NETORCA_VALID_STATES}")
+            change[FIELDS_STATE] = change_state
+    elif not (params.get(FIELDS_UUID) and params.get(FIELDS_STATE)):
+        fail_module(
+            module,
+            f"Either {FIELDS_CHANGES} or {FIELDS_UUID} and {FIELDS_STATE} required")
+    # Check that State is one of valid states, in any case
+    state = (params.get(FIELDS_STATE) or '').upper()
+    if state and state not in NETORCA_VALID_STATES_SET:
+        fail_module(
+            module,
+            f"{params[FIELDS_STATE]} is not one of {NETORCA_VALID_STATES}"
+        )
+    if state:
+        # NetOrca expects the states in upper case
+        params[FIELDS_STATE] = state
     # TODO Add validation of deployed_item
     # TODO Add validation of UUID
-    return valid
 
 
 def run_module(module):
@@ -173,39 +279,103 @@ def run_module(module):
         message=''
     )
 
-    # Validate input
-    if validate_params(module):
-
-        # Login
-        if FIELDS_API_KEY not in module.params or not module.params[FIELDS_API_KEY]:
-            api_key = login(
-                module.params[FIELDS_URL],
-                module.params[FIELDS_USER],
-                module.params[FIELDS_PASS]
-            )
-        else:
-            api_key = module.params[FIELDS_API_KEY]
+    # Validate input, bad options end the module in fail_module
+    validate_params(module)
+    params = module.params
 
+    if params[FIELDS_CHANGES]:
+        # Several changes go to NetOrca in bulk updates where supported
+        func = update_change_instances
+        kwargs = {
+            'updates': [
+                {
+                    'uuid': change[FIELDS_UUID],
+                    'state': change[FIELDS_STATE],
+                    **({'description': change[FIELDS_DESCRIPTION]}
+                       if change.get(FIELDS_DESCRIPTION) else {}),
+                    **({'deployed_item': change[FIELDS_DEPLOYED_ITEM]}
+                       if change.get(FIELDS_DEPLOYED_ITEM) else {})
+                }
+                for change in params[FIELDS_CHANGES]
+            ],
+            'max_batch_size': params[FIELDS_MAX_BATCH_SIZE],
+            'max_workers': params[FIELDS_CONCURRENCY],
+            'skip_unchanged': params[FIELDS_SKIP_UNCHANGED],
+            'check_mode': module.check_mode
+        }
+    else:
+        description = params[FIELDS_DESCRIPTION]
+        deployed_item = params[FIELDS_DEPLOYED_ITEM]
+        # Only the fields that are given are sent
         data = {
-            'description': {'test':'test'},
-            'state': module.params[FIELDS_STATE],
+            'state': params[FIELDS_STATE],
+            **({'description': description} if description else {}),
+            **({'deployed_item': deployed_item} if deployed_item else {})
         }
-        if FIELDS_DEPLOYED_ITEM in module.params and module.params[FIELDS_DEPLOYED_ITEM]:
-            data.update({'deployed_item': module.params[FIELDS_DEPLOYED_ITEM] })
-
-        reply = update_change_instance(
-                base_url=module.params[FIELDS_URL],
-                token=api_key,
-                uuid=module.params[FIELDS_UUID],
-                data=data
-        )
-        result['change_instance']=reply
-        result['changed']= True
-        result['message']= f"Updated {module.params[FIELDS_UUID]} change item"
+        func = update_change_instance
+        kwargs = {'uuid': params[FIELDS_UUID], 'data': data}
+        if params[FIELDS_SKIP_UNCHANGED]:
+            func = update_change_instance_if_changed
+            kwargs['check_mode'] = module.check_mode
 
+    if module.check_mode and not params[FIELDS_SKIP_UNCHANGED]:
+        # Nothing is sent to NetOrca, not even the login. With
+        # skip_if_unchanged the change instances are read to tell
+        # whether they would change
+        result['changed']= True
+        if params[FIELDS_CHANGES]:
+            result['message']= f"Would update {len(params[FIELDS_CHANGES])} change items"
+        else:
+            result['message']= f"Would update {params[FIELDS_UUID]} change item"
         module.exit_json(**result)
 
+    # One session for the login and the update so the connection is reused
+    try:
+        with build_session(max_workers=params[FIELDS_CONCURRENCY],
+                           timeout=params[FIELDS_TIMEOUT]) as session:
+            reply = call_authenticated(
+                    func,
+                    base_url=params[FIELDS_URL],
+                    token=params[FIELDS_API_KEY],
+                    username=params[FIELDS_USER],
+                    password=params[FIELDS_PASS],
+                    token_cache=params[FIELDS_TOKEN_CACHE],
+                    session=session,
+                    **kwargs
+            )
+    except REQUEST_ERRORS as error:
+        fail_module(module, f"Request to NetOrca failed: {error}")
+    verb = 'Would update' if module.check_mode else 'Updated'
+    if params[FIELDS_CHANGES]:
+        if reply['failed']:
+            # The other changes were still updated, report them as well
+            fail_module(
+                module,
+                f"{verb} {reply['count']} change items, failed to update "
+                f"{', '.join(reply['failed'])}",
+                change_instances=reply['change_instances'],
+                failures=reply['failures'])
+        result['change_instances']=reply['change_instances']
+        result['changed']= reply['count'] > 0
+        result['message']= f"{verb} {reply['count']} change items"
+        if reply['unchanged']:
+            result['message'] += f", {len(reply['unchanged'])} already up to date"
+    else:
+        changed = True
+        if params[FIELDS_SKIP_UNCHANGED]:
+            reply, changed = reply
+        result['change_instance']=reply
+        result['changed']= changed
+        if changed:
+            result['message']= f"{verb} {params[FIELDS_UUID]} change item"
+        else:
+            result['message']= f"{params[FIELDS_UUID]} change item already up to date"
+
+    module.exit_json(**result)
+
 def main():
+    # Only sets up logging when NETORCA_DEBUG_LOG asks for a debug log
+    ensure_logger()
     module = AnsibleModule(
         argument_spec=FIELDS,
         supports_check_mode=True